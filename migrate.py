@@ -14,16 +14,27 @@ PostgreSQL → MongoDB 活動資料遷移工具（生产环境最终修正版）
 
 import os
 import sys
-import json
+import orjson
+import time
+import queue
+import signal
 import logging
 import datetime
 import argparse
-from typing import Set
+import functools
+import threading
+from typing import List, Set
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from collections import defaultdict
 
 import psycopg2
 from psycopg2.extras import DictCursor
-from pymongo import MongoClient, UpdateOne, IndexModel
+from psycopg2.pool import ThreadedConnectionPool
+from pymongo import MongoClient, UpdateOne, IndexModel, timeout as mongo_timeout
+from pymongo.errors import BulkWriteError
+from pymongo.write_concern import WriteConcern
 from dotenv import load_dotenv
 from decimal import Decimal
 from bson.decimal128 import Decimal128
@@ -37,24 +48,57 @@ POSTGRESQL_CONFIG = {
     "host": os.getenv("PG_HOST"), "port": int(os.getenv("PG_PORT", 5432)),
     "user": os.getenv("PG_USER"), "password": os.getenv("PG_PASSWORD"),
     "dbname": os.getenv("PG_DBNAME"),
+    # 長時間執行的同步：開啟 TCP keepalive，及早偵測被中間設備靜默切斷的連線，而非卡在 fetch
+    "keepalives": 1, "keepalives_idle": 30, "keepalives_interval": 10, "keepalives_count": 5,
+    # 於 pg_stat_activity / MongoDB profiler 中辨識遷移工具的連線
+    "application_name": "sogo-migrate",
 }
 
 MONGO_URI = os.getenv("MONGO_URI")
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", "500"))
+# 自適應批次：單批 Mongo 寫入耗時低於目標則放大 25%，超過目標兩倍則減半 (AIMD)
+BATCH_TARGET_SECONDS = float(os.getenv("BATCH_TARGET_SECONDS", "1.0"))
+MIN_BATCH_SIZE = min(50, BATCH_SIZE)
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "10000"))
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "4"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "300000"))
+# 建索引、去重等管理操作在大集合上可能遠超 socketTimeoutMS；以 pymongo.timeout() 另給較長的時限 (秒)
+MONGO_ADMIN_TIMEOUT_SECONDS = float(os.getenv("MONGO_ADMIN_TIMEOUT_SECONDS", "21600"))
+# 傳輸壓縮，例如 "zstd,zlib" (zstd 需安裝 zstandard 套件)；未設定則不壓縮
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "")
+# 遷移寫入的確認等級："1" (預設，w=1 不等待 journal) 或 "0" (不確認，最快，錯誤不會回報，僅建議在可整批重跑的全量載入使用)
+MONGO_WRITE_CONCERN = os.getenv("MONGO_WRITE_CONCERN", "1")
 SCHEMA = "gift2022"
 
+HOSTNAME = os.uname().nodename.split('.')[0]
 CHECKPOINT_FILE = "migration_checkpoint.json"
+# 同一狀態下的進度更新累積 N 批或 T 秒才落盤一次；狀態轉換則立即寫入
+CHECKPOINT_FLUSH_EVERY = int(os.getenv("CHECKPOINT_FLUSH_EVERY", "20"))
+CHECKPOINT_FLUSH_INTERVAL = float(os.getenv("CHECKPOINT_FLUSH_INTERVAL", "5"))
 LOG_DIR = "logs"
+# 全量同步視窗的結束時間 (開放上界)；查詢時省略此上界條件
+FULL_SYNC_END_TIME = "9999-12-31T23:59:59Z"
 
 # ===== 全域變數 =====
 logger = None
+log_listener = None
 args = None
+pg_pool = None
 pg_conn = None
 pg_cursor = None
 mongo_client = None
 mongo_dbs = {}
 cp_data = {}
 VALID_EVENT_NOS: Set[str] = set()
+# 白名單的排序清單，載入時建立一次，供 SQL ANY(%s) 與 Mongo $in 直接重複使用
+VALID_EVENT_NOS_LIST: List[str] = []
+checkpoint_lock = threading.Lock()
+cp_pending_updates = 0
+cp_last_flush = 0.0
+checkpoint_flusher = None
+stats_lock = threading.Lock()
+# 收到 SIGTERM 後設定，各視窗在批次之間檢查並停下，讓 finally 寫出最後一份 checkpoint
+shutdown_event = threading.Event()
 
 MIGRATION_STATS = {
     "tables": {}, "total_pg_records": 0, "total_inserted": 0,
@@ -66,7 +110,7 @@ TABLES_CONFIG = {
     "events": {
         "pg_table": "gif_event", "add_date_field": "add_date", "mod_date_field": "mod_date",
         "id_field": "event_no", "mongo_collection": "events", "verification_mode": "primary_count",
-        "link_field": "event_no"
+        "link_field": "event_no", "batch_size": 200
     },
     "hcc_events": {
         "pg_table": "gif_hcc_event", "add_date_field": "add_date", "mod_date_field": "mod_date",
@@ -76,59 +120,111 @@ TABLES_CONFIG = {
     "attendees": {
         "pg_table": "gif_hcc_event_attendee", "add_date_field": "add_date", "mod_date_field": "mod_date",
         "id_field": "id", "mongo_collection": "event_attendees", "verification_mode": "primary_count",
-        "link_field": "event_no"
+        "link_field": "event_no", "insert_on_full_sync": True, "batch_size": 2000
     },
     "coupon_burui": {
         "pg_table": "gif_event_coupon_burui", "add_date_field": "add_date", "mod_date_field": "mod_date",
         "id_field": "id", "mongo_collection": "events", "embed_array_field": "usingBranchIds",
-        "verification_mode": "embed_array"
+        "verification_mode": "embed_array",
+        # 嵌入陣列只取用單一欄位，其餘欄位僅供斷點使用；明確列出欄位以減少傳輸與轉換
+        "select_columns": ["id", "branch", "add_date", "mod_date"]
     },
     "member_types": {
         "pg_table": "gif_hcc_event_member_type", "add_date_field": "add_date", "mod_date_field": "mod_date",
         "id_field": "id", "mongo_collection": "events", "embed_array_field": "memberTypes",
         "verification_mode": "embed_array",
-        "link_field": "event_no"
+        "link_field": "event_no", "select_columns": ["id", "event_no", "member_type", "add_date", "mod_date"]
     },
 }
 
-def init_logger(task_name="general"):
-    global logger
+# 執行分道：同一分道內依序執行，不同分道並行。
+# hcc_events 與嵌入陣列皆以 upsert=False 更新 events 文件，必須排在 events 之後；attendees 寫入獨立集合，可單獨並行。
+EXECUTION_LANES = [
+    ["events", "hcc_events", "coupon_burui", "member_types"],
+    ["attendees"],
+]
+
+def init_logger(task_name="general", background=True, verbose=False):
+    """
+    background=True 時，檔案與終端輸出交由背景 QueueListener 處理，
+    同步執行緒只需將紀錄放入佇列，不會被磁碟寫入阻塞。
+    verbose=True 時輸出 DEBUG 等級 (逐批進度、執行的 SQL)。
+    """
+    global logger, log_listener
     os.makedirs(LOG_DIR, exist_ok=True)
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
-    short_hostname = os.uname().nodename.split('.')[0]
     pid = os.getpid()
-    log_filename = f"{timestamp}_{task_name}_{short_hostname}_{pid}.log"
+    log_filename = f"{timestamp}_{task_name}_{HOSTNAME}_{pid}.log"
     log_file_path = os.path.join(LOG_DIR, log_filename)
-    if logging.getLogger().hasHandlers():
-        logging.getLogger().handlers.clear()
-    logging.basicConfig(
-        filename=log_file_path, level=logging.INFO, format="[%(asctime)s] %(levelname)s: %(message)s",
-    )
+    root_logger = logging.getLogger()
+    if root_logger.hasHandlers():
+        root_logger.handlers.clear()
+    log_level = logging.DEBUG if verbose else logging.INFO
+    root_logger.setLevel(log_level)
+    # 本工具使用 root logger；pymongo 的 DEBUG 會逐筆記錄命令文件 (含整批 bulk_write)，維持 INFO 以免淹沒逐批進度與 SQL
+    logging.getLogger("pymongo").setLevel(logging.INFO)
+    formatter = logging.Formatter("[%(asctime)s] %(levelname)s: %(message)s")
+    file_handler = logging.FileHandler(log_file_path)
+    file_handler.setFormatter(formatter)
     console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setLevel(logging.INFO)
-    console_handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s: %(message)s"))
-    logging.getLogger().addHandler(console_handler)
-    logger = logging.getLogger()
+    console_handler.setLevel(log_level)
+    console_handler.setFormatter(formatter)
+    if background:
+        log_queue = queue.Queue(-1)
+        root_logger.addHandler(QueueHandler(log_queue))
+        log_listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+        log_listener.start()
+    else:
+        root_logger.addHandler(file_handler)
+        root_logger.addHandler(console_handler)
+    logger = root_logger
     logger.info(f"日誌檔案位於: {os.path.abspath(log_file_path)}")
 
+MONGO_INDEXES = {
+    "events": [IndexModel([("eventNo", 1)], name="idx_eventNo", unique=True)],
+    "event_attendees": [IndexModel([("eventNo", 1), ("appId", 1)], name="idx_eventNo_appId", unique=True)],
+}
+
 def ensure_mongodb_indexes(mdb):
     logger.info("開始檢查並建立 MongoDB 索引...")
     try:
-        events_collection = mdb["events"]
-        event_no_index = IndexModel([("eventNo", 1)], name="idx_eventNo", unique=True)
-        events_collection.create_indexes([event_no_index])
-        logger.info(f"成功檢查/建立 events 集合的索引: idx_eventNo (unique)")
-        
-        attendees_collection = mdb["event_attendees"]
-        attendee_compound_index = IndexModel([("eventNo", 1), ("appId", 1)], name="idx_eventNo_appId", unique=True)
-        attendees_collection.create_indexes([attendee_compound_index])
-        logger.info(f"成功檢查/建立 event_attendees 集合的索引: idx_eventNo_appId (unique)")
+        for collection_name, index_models in MONGO_INDEXES.items():
+            collection = mdb[collection_name]
+            # 先讀取現有索引名稱，只建立缺少的索引，省去每次啟動重複送出 createIndexes
+            existing = collection.index_information()
+            missing = [m for m in index_models if m.document["name"] not in existing]
+            if missing:
+                with mongo_timeout(MONGO_ADMIN_TIMEOUT_SECONDS):
+                    # 缺少的唯一索引可能是全量同步中途被強制終止 (SIGKILL、OOM) 而未重建，期間重放的批次會留下重複文件
+                    for index_model in missing:
+                        if index_model.document.get("unique"):
+                            remove_duplicates_for_unique_index(collection, index_model)
+                    collection.create_indexes(missing)
+                logger.info(f"成功建立 {collection_name} 集合的索引: {', '.join(m.document['name'] for m in missing)}")
+            else:
+                logger.info(f"{collection_name} 集合的索引已存在，略過建立。")
         
         logger.info("MongoDB 索引檢查完畢。")
     except Exception as e:
         logger.error(f"建立 MongoDB 索引時發生錯誤: {e}", exc_info=True)
         raise
 
+def remove_duplicates_for_unique_index(collection, index_model):
+    """建立唯一索引前，依索引鍵欄位去除重複文件 (每組只保留一筆)，回傳移除筆數。"""
+    # 去重需要 deleted_count，不論遷移寫入設定為何都使用確認寫入
+    collection = collection.with_options(write_concern=WriteConcern(w=1))
+    key_fields = list(index_model.document["key"])
+    pipeline = [
+        {"$group": {"_id": {field: f"${field}" for field in key_fields}, "ids": {"$push": "$_id"}, "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gt": 1}}}
+    ]
+    removed = 0
+    for group in collection.aggregate(pipeline, allowDiskUse=True):
+        removed += collection.delete_many({"_id": {"$in": group["ids"][1:]}}).deleted_count
+    if removed:
+        logger.warning(f"{collection.name} 建立索引 {index_model.document['name']} 前移除了 {removed} 筆重複文件。")
+    return removed
+
 def ensure_postgresql_indexes(conn):
     logger.info("開始檢查並建立 PostgreSQL 索引...")
     indexes_to_create = [
@@ -143,10 +239,27 @@ def ensure_postgresql_indexes(conn):
         f"CREATE INDEX IF NOT EXISTS ix_gif_hcc_event_attendee_mod_date ON {SCHEMA}.gif_hcc_event_attendee (mod_date)",
         f"CREATE INDEX IF NOT EXISTS ix_gif_event_coupon_burui_coupon_setting_no ON {SCHEMA}.gif_event_coupon_burui (coupon_setting_no)",
     ]
+    # 視窗查詢以 COALESCE(mod_date, add_date, '1970-01-01'), id 過濾與排序；建立相同運算式的索引，
+    # 讓 keyset 斷點條件與 ORDER BY 可直接走索引範圍掃描，而非全表掃描後排序
+    for conf in TABLES_CONFIG.values():
+        indexes_to_create.append(
+            f"CREATE INDEX IF NOT EXISTS ix_{conf['pg_table']}_effective_ts_{conf['id_field']} ON {SCHEMA}.{conf['pg_table']} "
+            f"((COALESCE({conf['mod_date_field']}, {conf['add_date_field']}, '1970-01-01')), {conf['id_field']})"
+        )
     with conn.cursor() as cur:
+        # 先將所有 CREATE INDEX IF NOT EXISTS 合併為一次送出，只需一次往返；任一失敗時整批回滾，改為逐條執行並跳過失敗者
+        try:
+            logger.debug("嘗試一次執行 %d 條索引語句", len(indexes_to_create))
+            cur.execute(";\n".join(indexes_to_create))
+            conn.commit()
+            logger.info("PostgreSQL 索引檢查完畢。")
+            return
+        except psycopg2.Error as e:
+            logger.warning(f"批次建立 PostgreSQL 索引失敗，改為逐條執行: {e.pgcode} {e.pgerror}")
+            conn.rollback()
         for sql in indexes_to_create:
             try:
-                logger.info(f"嘗試執行: {sql}")
+                logger.debug("嘗試執行: %s", sql)
                 cur.execute(sql)
             except psycopg2.Error as e:
                 logger.warning(f"建立 PostgreSQL 索引失敗 (已跳過): {sql} - 原因: {e.pgcode} {e.pgerror}")
@@ -156,11 +269,13 @@ def ensure_postgresql_indexes(conn):
     logger.info("PostgreSQL 索引檢查完畢。")
 
 def init_db_conn():
-    global pg_conn, pg_cursor, mongo_client, mongo_dbs
+    global pg_pool, pg_conn, pg_cursor, mongo_client, mongo_dbs
     try:
-        pg_conn = psycopg2.connect(**POSTGRESQL_CONFIG)
+        # 連線池：主執行緒固定持有一條 (白名單、校驗用)，其餘供各視窗同步借用
+        pg_pool = ThreadedConnectionPool(1, MAX_WORKERS + 1, **POSTGRESQL_CONFIG)
+        pg_conn = pg_pool.getconn()
         pg_cursor = pg_conn.cursor(cursor_factory=DictCursor)
-        if not args.skip_pg_index_check:
+        if args.init_indexes or not args.skip_pg_index_check:
             ensure_postgresql_indexes(pg_conn)
         else:
             logger.warning("已跳過 PostgreSQL 索引檢查。")
@@ -168,107 +283,252 @@ def init_db_conn():
         logger.error(f"無法連接 PostgreSQL：{e}", exc_info=True)
         sys.exit(1)
     try:
-        mongo_client = MongoClient(MONGO_URI)
+        mongo_options = {"compressors": MONGO_COMPRESSORS} if MONGO_COMPRESSORS else {}
+        # 連線池預先保留每條分道所需連線，閒置連線定期回收；找不到可用節點時快速失敗
+        mongo_client = MongoClient(MONGO_URI, maxPoolSize=MAX_WORKERS * 2, minPoolSize=MAX_WORKERS, maxIdleTimeMS=120000,
+                                   retryWrites=True, socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS, connectTimeoutMS=20000,
+                                   serverSelectionTimeoutMS=10000, appname="sogo-migrate", **mongo_options)
         mdb = mongo_client["gift"]
-        ensure_mongodb_indexes(mdb)
+        if args.init_indexes or not args.skip_mongo_index_check:
+            ensure_mongodb_indexes(mdb)
+        else:
+            logger.warning("已跳過 MongoDB 索引檢查。")
+        # 遷移寫入皆為冪等 upsert，可由 checkpoint 重跑：使用 w=1 且不等待 journal，縮短每批 bulk_write 的確認延遲；
+        # --safe-write 則改為等待多數節點確認
+        if args.safe_write:
+            migration_write_concern = WriteConcern(w="majority")
+            logger.info("已啟用 --safe-write，MongoDB 寫入等待多數節點確認 (w=majority)。")
+        elif MONGO_WRITE_CONCERN == "0":
+            migration_write_concern = WriteConcern(w=0)
+            logger.warning("MONGO_WRITE_CONCERN=0：MongoDB 寫入不等待確認，寫入錯誤不會回報，新增/更新統計改以送出筆數估計。")
+        else:
+            migration_write_concern = WriteConcern(w=1, j=False)
         for k, v in TABLES_CONFIG.items():
-            mongo_dbs[k] = mdb[v["mongo_collection"]]
+            mongo_dbs[k] = mdb.get_collection(v["mongo_collection"], write_concern=migration_write_concern)
     except Exception as e:
         logger.error(f"無法連接 MongoDB 或建立索引：{e}", exc_info=True)
         sys.exit(1)
 
+@contextmanager
+def pg_connection():
+    """從連線池借出一條 PostgreSQL 連線，離開時歸還 (未提交的事務由連線池回滾)。"""
+    conn = pg_pool.getconn()
+    try:
+        yield conn
+    finally:
+        pg_pool.putconn(conn)
+
 def load_valid_event_nos():
-    global VALID_EVENT_NOS
+    global VALID_EVENT_NOS, VALID_EVENT_NOS_LIST
     logger.info("正在從 PostgreSQL 載入 event_no 白名單 (LIKE 'HCC%')...")
     sql = f"SELECT event_no FROM {SCHEMA}.gif_event WHERE event_no LIKE 'HCC%'"
     pg_cursor.execute(sql)
     results = pg_cursor.fetchall()
     VALID_EVENT_NOS = {row[0] for row in results}
+    VALID_EVENT_NOS_LIST = sorted(VALID_EVENT_NOS)
     if not VALID_EVENT_NOS:
         logger.warning("警告：在 gif_event 表中未找到任何以 'HCC' 開頭的活動，遷移將處理 0 筆主活動資料。")
     else:
         logger.info(f"白名單載入完畢，共 {len(VALID_EVENT_NOS)} 個有效的 event_no。")
 
-def fetch_batch(table_key, end_time, last_checkpoint_time, last_checkpoint_id, batch_size=100):
+@functools.lru_cache(maxsize=None)
+def build_window_sql(table_key, has_whitelist, has_end_bound, has_checkpoint):
+    """
+    產生視窗查詢 SQL；同一組 (表, 是否有白名單, 是否有結束上界, 是否從斷點續傳) 的 SQL 文字固定，
+    快取後每次開啟資料流只需組裝參數。
+    全量同步的開放視窗不帶上界，讓 PostgreSQL 直接依排序鍵掃描，不必先做範圍過濾。
+    """
     conf = TABLES_CONFIG[table_key]
     pg_table_alias = "t"
     join_clause = ""
-    select_clause = f"SELECT {pg_table_alias}.* FROM {SCHEMA}.{conf['pg_table']} {pg_table_alias}"
+    if "select_columns" in conf:
+        select_list = ", ".join(f"{pg_table_alias}.{col}" for col in conf["select_columns"])
+    else:
+        select_list = f"{pg_table_alias}.*"
+    select_clause = f"SELECT {select_list} FROM {SCHEMA}.{conf['pg_table']} {pg_table_alias}"
     
     if table_key == "coupon_burui":
         join_clause = f"JOIN {SCHEMA}.gif_event_coupon_setting s ON {pg_table_alias}.coupon_setting_no = s.coupon_setting_no"
-        select_clause = f"SELECT {pg_table_alias}.*, s.event_no FROM {SCHEMA}.{conf['pg_table']} {pg_table_alias}"
+        select_clause = f"SELECT {select_list}, s.event_no FROM {SCHEMA}.{conf['pg_table']} {pg_table_alias}"
 
     effective_timestamp_field = f"COALESCE({pg_table_alias}.{conf['mod_date_field']}, {pg_table_alias}.{conf['add_date_field']}, '1970-01-01')"
     id_field_with_alias = f"{pg_table_alias}.{conf['id_field']}"
     
     order_by_clause = f"ORDER BY {effective_timestamp_field}, {id_field_with_alias}"
 
-    params = []
     where_clauses = []
 
     link_field = conf.get("link_field", "event_no")
     event_no_field_in_query = "s.event_no" if table_key == "coupon_burui" else f"{pg_table_alias}.{link_field}"
     
-    if VALID_EVENT_NOS:
+    if has_whitelist:
         where_clauses.append(f"{event_no_field_in_query} = ANY(%s)")
-        params.append(list(VALID_EVENT_NOS))
     else:
         where_clauses.append("1=0") 
     
-    where_clauses.append(f"{effective_timestamp_field} < %s")
-    params.append(end_time)
+    if has_end_bound:
+        where_clauses.append(f"{effective_timestamp_field} < %s")
     
-    if last_checkpoint_time and last_checkpoint_id is not None:
-        where_clauses.append(f"({effective_timestamp_field} > %s OR ({effective_timestamp_field} = %s AND {id_field_with_alias} > %s))")
-        params.extend([last_checkpoint_time, last_checkpoint_time, last_checkpoint_id])
+    if has_checkpoint:
+        # 以列比較表示 keyset 條件，PostgreSQL 才能直接以 (有效時間, id) 索引定位起點，不必從頭掃描
+        where_clauses.append(f"({effective_timestamp_field}, {id_field_with_alias}) > (%s, %s)")
 
-    full_sql = f"{select_clause} {join_clause} WHERE {' AND '.join(where_clauses)} {order_by_clause} LIMIT %s"
-    params.append(batch_size)
-    
-    # logger.info(f"[SQL-{table_key}] {full_sql.replace(chr(10), ' ')}")
-    pg_cursor.execute(full_sql, params)
-    return pg_cursor.fetchall()
+    return f"{select_clause} {join_clause} WHERE {' AND '.join(where_clauses)} {order_by_clause}"
+
+def build_window_query(table_key, end_time, last_checkpoint_time, last_checkpoint_id):
+    has_whitelist = bool(VALID_EVENT_NOS)
+    has_end_bound = end_time != FULL_SYNC_END_TIME
+    has_checkpoint = bool(last_checkpoint_time) and last_checkpoint_id is not None
+    params = []
+    if has_whitelist:
+        params.append(VALID_EVENT_NOS_LIST)
+    if has_end_bound:
+        params.append(end_time)
+    if has_checkpoint:
+        params.extend([last_checkpoint_time, last_checkpoint_id])
+    return build_window_sql(table_key, has_whitelist, has_end_bound, has_checkpoint), params
+
+def open_window_cursor(conn, table_key, end_time, last_checkpoint_time, last_checkpoint_id):
+    """
+    以具名 (server-side) cursor 開啟整個視窗的資料流，之後以 fetchmany(批次大小) 逐批讀取。
+    查詢只在開啟時規劃一次；keyset 斷點條件僅用於從斷點 (或錯誤後) 重新開啟的那一次。
+    """
+    sql, params = build_window_query(table_key, end_time, last_checkpoint_time, last_checkpoint_id)
+    logger.debug("[SQL-%s] %s", table_key, sql)
+    # 使用預設 tuple 游標：每列不再建立 DictRow，欄位依 description 的位置轉換
+    cur = conn.cursor(name=f"mig_{table_key}")
+    cur.execute(sql, params)
+    return cur
+
+def close_window_cursor(cur):
+    """關閉視窗 cursor；事務已中止時關閉可能失敗，直接忽略 (rollback 會一併釋放)。"""
+    if cur is not None:
+        try:
+            cur.close()
+        except psycopg2.Error:
+            pass
+    return None
 
 def normalize_value(v):
+    # 依確切型別查表，常見型別一次字典查找即可；查不到 (子類別等少見型別) 才走 isinstance 判斷
+    convert = _NORMALIZERS.get(type(v))
+    if convert is not None: return convert(v)
     if isinstance(v, Decimal): return Decimal128(v)
     if isinstance(v, datetime.datetime): return v.replace(tzinfo=timezone.utc) if v.tzinfo is None else v
     if isinstance(v, date): return datetime.datetime.combine(v, datetime.time.min, tzinfo=timezone.utc)
     return v
 
+@functools.lru_cache(maxsize=1024)
 def snake_to_camel(snake_str):
+    # 欄位名稱集合固定，快取後每列每欄只剩一次字典查找
     if not isinstance(snake_str, str): return snake_str
     components = snake_str.split('_')
     return components[0] + ''.join(x.title() for x in components[1:])
 
-def transform_row_to_doc(row):
-    doc = {}
-    for key, value in row.items():
-        camel_key = snake_to_camel(key)
-        transformed_value = value
-        if isinstance(value, str):
-            if value.upper() == 'Y': transformed_value = True
-            elif value.upper() == 'N': transformed_value = False
-        doc[camel_key] = normalize_value(transformed_value)
-    return doc
-
-def upsert_batch(table_key, rows):
+# Y/N 旗標欄位轉布林；以查表取代每個字串欄位兩次 upper() 比對
+_YN_BOOL = {"Y": True, "y": True, "N": False, "n": False}
+
+# 依 PostgreSQL 欄位型別 OID 預先決定每欄的轉換函式，省去每格一連串 isinstance 判斷
+def _convert_numeric(v): return None if v is None else Decimal128(v)
+def _convert_timestamp(v): return v.replace(tzinfo=timezone.utc) if v is not None and v.tzinfo is None else v
+def _convert_date(v): return None if v is None else datetime.datetime.combine(v, datetime.time.min, tzinfo=timezone.utc)
+def _convert_text(v): return _YN_BOOL.get(v, v)
+def _convert_identity(v): return v
+
+def _convert_generic(v):
+    if isinstance(v, str): v = _YN_BOOL.get(v, v)
+    return normalize_value(v)
+
+_CONVERTERS_BY_OID = {
+    1700: _convert_numeric,                                        # numeric
+    1082: _convert_date,                                           # date
+    1114: _convert_timestamp, 1184: _convert_timestamp,            # timestamp, timestamptz
+    25: _convert_text, 1043: _convert_text, 1042: _convert_text, 18: _convert_text,  # text, varchar, bpchar, char
+    16: _convert_identity, 20: _convert_identity, 21: _convert_identity, 23: _convert_identity,  # bool, int8, int2, int4
+}
+
+# normalize_value 的型別查表；datetime 是 date 的子類別，以確切型別區分可避免誤判
+_NORMALIZERS = {
+    Decimal: _convert_numeric, datetime.datetime: _convert_timestamp, date: _convert_date,
+    str: _convert_identity, int: _convert_identity, float: _convert_identity, bool: _convert_identity, type(None): _convert_identity,
+}
+
+@functools.lru_cache(maxsize=64)
+def build_row_plan(columns):
+    """columns 為 ((欄位名, 型別 OID), ...)；回傳 ((camelCase 鍵, 轉換函式), ...)，未知型別使用完整的通用轉換。"""
+    return tuple((snake_to_camel(name), _CONVERTERS_BY_OID.get(type_code, _convert_generic)) for name, type_code in columns)
+
+def row_plan_for_cursor(cur):
+    if not cur.description: return None
+    return build_row_plan(tuple((col[0], col[1]) for col in cur.description))
+
+def transform_row_to_doc(row, row_plan):
+    """row 為視窗游標的 tuple 列，row_plan 為 build_row_plan 產生的 ((camelCase 鍵, 轉換函式), ...)。"""
+    return {key: convert(value) for (key, convert), value in zip(row_plan, row)}
+
+def insert_batch_tolerating_duplicates(table_key, filtered_docs):
+    """
+    全量同步的快速路徑：以 insert_many(ordered=False) 直接寫入，省去 upsert 的比對階段。
+    遇到唯一索引衝突 (E11000，例如中斷後重跑) 的文件，改以 upsert 補寫，保持冪等。
+    回傳 (新增數, 更新數)。
+    """
+    collection = mongo_dbs[table_key]
+    docs = [doc for _, doc in filtered_docs]
+    try:
+        result = collection.insert_many(docs, ordered=False, bypass_document_validation=True)
+        return len(result.inserted_ids), 0
+    except BulkWriteError as bwe:
+        write_errors = bwe.details.get("writeErrors", [])
+        if any(err.get("code") != 11000 for err in write_errors):
+            raise
+        inserted = bwe.details.get("nInserted", 0)
+
+    retry_requests = []
+    for err in write_errors:
+        filter_cond, doc = filtered_docs[err["index"]]
+        doc.pop("_id", None)  # insert_many 會回填 _id，不可帶進 $set
+        retry_requests.append(UpdateOne(filter_cond, {"$set": doc}, upsert=True))
+    result = collection.bulk_write(retry_requests, ordered=False)
+    return inserted + result.upserted_count, result.modified_count
+
+def upsert_batch(table_key, rows, mode, row_plan):
+    """將一批 PG 資料 (tuple 列，依 row_plan 轉換) 寫入 MongoDB，回傳 (新增數, 更新數)。"""
     conf = TABLES_CONFIG[table_key]
+    # 不確認寫入 (w=0) 時無法得知 E11000 重複，重跑會留下舊資料；此時改走 upsert 以保持冪等
+    use_insert = mode == "full" and conf.get("insert_on_full_sync", False) and mongo_dbs[table_key].write_concern.acknowledged
     requests = []
+    inserts = []
+    # 每批固定的設定值先取出，迴圈內不再重複查表
+    array_field = conf.get("embed_array_field")
+    embed_value_key = {"usingBranchIds": "branch", "memberTypes": "memberType"}.get(array_field)
+    is_hcc_events = table_key == "hcc_events"
+    is_attendees = table_key == "attendees"
+    id_field_camel = snake_to_camel(conf["id_field"])
+    # 嵌入陣列表只用到 eventNo 與單一值欄位，只轉換這兩欄，其餘欄位 (id、時間戳) 不做轉換
+    embed_columns = None
+    if embed_value_key:
+        plan_keys = [key for key, _ in row_plan]
+        if "eventNo" in plan_keys and embed_value_key in plan_keys:
+            event_idx, value_idx = plan_keys.index("eventNo"), plan_keys.index(embed_value_key)
+            embed_columns = (event_idx, row_plan[event_idx][1], value_idx, row_plan[value_idx][1])
+    # 嵌入陣列表：同一活動的多筆值合併為單一 $addToSet + $each，減少每批的寫入操作數
+    embed_values = defaultdict(list)
     for row in rows:
-        doc = transform_row_to_doc(row)
-        if "embed_array_field" in conf:
-            array_field = conf["embed_array_field"]
+        if embed_columns:
+            event_idx, convert_event, value_idx, convert_value = embed_columns
+            event_no, value_to_add = convert_event(row[event_idx]), convert_value(row[value_idx])
+            if event_no and value_to_add:
+                embed_values[event_no].append(value_to_add)
+            continue
+        doc = transform_row_to_doc(row, row_plan)
+        if array_field:
             event_no = doc.get("eventNo")
             if not event_no: continue
-            filter_cond = {"eventNo": event_no}
-            if array_field == "usingBranchIds": value_to_add = doc.get("branch")
-            elif array_field == "memberTypes": value_to_add = doc.get("memberType")
-            else: value_to_add = doc
+            value_to_add = doc.get(embed_value_key) if embed_value_key else doc
             if value_to_add:
-                requests.append(UpdateOne(filter_cond, {"$addToSet": {array_field: value_to_add}}, upsert=False))
+                embed_values[event_no].append(value_to_add)
         
-        elif table_key == "hcc_events":
+        elif is_hcc_events:
             event_no = doc.get("eventNo")
             if not event_no: continue
             doc.pop("eventNo", None)
@@ -277,37 +537,138 @@ def upsert_batch(table_key, rows):
             requests.append(UpdateOne({"eventNo": event_no}, update_op, upsert=False))
 
         else: # 主 collection (events, attendees)
-            id_field_camel = snake_to_camel(conf["id_field"])
-            if table_key == "attendees":
+            if is_attendees:
                 filter_cond = {"eventNo": doc.get("eventNo"), "appId": doc.get("appId")}
             else:
                 if id_field_camel not in doc: continue
                 filter_cond = {id_field_camel: doc[id_field_camel]}
-            requests.append(UpdateOne(filter_cond, {"$set": doc}, upsert=True))
+            if use_insert:
+                inserts.append((filter_cond, doc))
+            else:
+                requests.append(UpdateOne(filter_cond, {"$set": doc}, upsert=True))
     
-    if not requests: return None
+    for event_no, values in embed_values.items():
+        # 同批重複值 (例如同活動多張券設定同一分店) 先去重，縮小送出的 $each 陣列；值為文件 (不可雜湊) 時維持原樣
+        try: values = list(dict.fromkeys(values))
+        except TypeError: pass
+        requests.append(UpdateOne({"eventNo": event_no}, {"$addToSet": {array_field: {"$each": values}}}, upsert=False))
     
-    return mongo_dbs[table_key].bulk_write(requests, ordered=False)
+    if inserts:
+        return insert_batch_tolerating_duplicates(table_key, inserts)
+    if not requests: return 0, 0
+    
+    collection = mongo_dbs[table_key]
+    # pymongo 不允許在不確認寫入 (w=0) 時設定 bypass_document_validation，僅在確認寫入時略過驗證
+    result = collection.bulk_write(requests, ordered=False, bypass_document_validation=collection.write_concern.acknowledged)
+    # 不確認寫入 (w=0) 時伺服器不回傳結果，以送出的操作數計為更新
+    if not result.acknowledged: return 0, len(requests)
+    return result.upserted_count, result.modified_count
 
 def update_checkpoint_window(table_key, window_to_update, new_checkpoint_time, new_checkpoint_id, processed_count_delta, status):
-    global cp_data
-    cp_table = cp_data.setdefault(table_key, {})
-    
-    for w in cp_table.setdefault("base_windows", []):
-        if w["start"] == window_to_update["start"] and w["end"] == window_to_update["end"] and w.get("mode") == window_to_update.get("mode"):
-            w.update({
-                "last_checkpoint_time": new_checkpoint_time,
-                "last_checkpoint_id": str(new_checkpoint_id) if new_checkpoint_id is not None else None,
-                "processed_count": w.get("processed_count", 0) + processed_count_delta,
-                "owner": os.uname().nodename.split('.')[0],
-                "status": status
-            })
-            if status == "completed": 
-                w["finish_exec_time"] = datetime.datetime.now(timezone.utc).isoformat()
-            break
-    save_checkpoint(cp_data)
+    global cp_data, cp_pending_updates, cp_last_flush
+    with checkpoint_lock:
+        cp_table = cp_data.setdefault(table_key, {})
+        status_changed = False
+        
+        for w in cp_table.setdefault("base_windows", []):
+            if w["start"] == window_to_update["start"] and w["end"] == window_to_update["end"] and w.get("mode") == window_to_update.get("mode"):
+                status_changed = w.get("status") != status
+                w.update({
+                    "last_checkpoint_time": new_checkpoint_time,
+                    "last_checkpoint_id": str(new_checkpoint_id) if new_checkpoint_id is not None else None,
+                    "processed_count": w.get("processed_count", 0) + processed_count_delta,
+                    "owner": HOSTNAME,
+                    "status": status
+                })
+                if status == "completed": 
+                    w["finish_exec_time"] = datetime.datetime.now(timezone.utc).isoformat()
+                break
+
+        # 斷點更新是冪等的 (重跑只會重複 upsert)，因此批次進度可延遲落盤，避免每批都重寫整份檔案
+        cp_pending_updates += 1
+        now = time.monotonic()
+        if status_changed or cp_pending_updates >= CHECKPOINT_FLUSH_EVERY or now - cp_last_flush >= CHECKPOINT_FLUSH_INTERVAL:
+            save_checkpoint(cp_data)
+            cp_pending_updates = 0
+            cp_last_flush = now
+
+class AdaptiveBatchSize:
+    """
+    依每批 Mongo 寫入耗時調整批次大小：快於目標則加大 25%，慢於兩倍目標則減半。
+    初始值取自 TABLES_CONFIG 的 batch_size (窄表可較大、寬表較小)，未設定則使用 BATCH_SIZE。
+    """
+    def __init__(self, initial):
+        self.value = max(MIN_BATCH_SIZE, min(MAX_BATCH_SIZE, initial))
+
+    def record(self, batch_rows, requested_size, elapsed):
+        # requested_size 為抓取該批時的批次大小；預取的批次可能早於上次調整，須以其自身大小判斷並推算新值，
+        # 否則縮小後仍滿載的舊批次會被重複判定為過慢而連續減半
+        # 最後一批可能不滿，只以滿批的耗時調整
+        if batch_rows < requested_size: return
+        if elapsed > BATCH_TARGET_SECONDS * 2:
+            self.value = max(MIN_BATCH_SIZE, requested_size // 2)
+        elif elapsed < BATCH_TARGET_SECONDS:
+            self.value = min(MAX_BATCH_SIZE, int(requested_size * 1.25))
+
+class WindowBatchPrefetcher:
+    """
+    背景執行緒持有視窗的命名游標並預先抓取下一批資料，讓 PG fetch 與 Mongo 寫入重疊進行。
+    PG 錯誤會放入佇列，由取用端在 get() 時拋出；close() 會停止並等待執行緒結束，之後才可在連線上 commit/rollback。
+    get() 回傳 (rows, 抓取時的批次大小)，供 AdaptiveBatchSize 判斷預取批次。
+    """
+    def __init__(self, conn, table_key, end_time, last_checkpoint_time, last_checkpoint_id, batch_size):
+        self._batch_size = batch_size
+        self._queue = queue.Queue(maxsize=2)
+        self._stop = threading.Event()
+        self.row_plan = None
+        self.columns = None
+        self._thread = threading.Thread(
+            target=self._run, args=(conn, table_key, end_time, last_checkpoint_time, last_checkpoint_id),
+            name=f"prefetch-{table_key}", daemon=True)
+        self._thread.start()
+
+    def _run(self, conn, table_key, end_time, last_checkpoint_time, last_checkpoint_id):
+        cur = None
+        try:
+            cur = open_window_cursor(conn, table_key, end_time, last_checkpoint_time, last_checkpoint_id)
+            while not self._stop.is_set():
+                requested_size = self._batch_size.value
+                rows = cur.fetchmany(requested_size)
+                # 命名游標在第一次 fetch 後才有 description；於放入佇列前建立，取用端取得資料時必已可見
+                if self.row_plan is None:
+                    self.columns = tuple(col[0] for col in cur.description or ())
+                    self.row_plan = row_plan_for_cursor(cur)
+                self._put((rows, requested_size))
+                if not rows: break
+        except Exception as e:
+            self._put(e)
+        finally:
+            close_window_cursor(cur)
+
+    def _put(self, item):
+        # 佇列滿時定期檢查停止旗標，避免取用端已放棄時永久阻塞
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def get(self):
+        item = self._queue.get()
+        if isinstance(item, Exception): raise item
+        return item
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        return None
 
 def migrate_table_window(table_key, window):
+    with pg_connection() as conn:
+        _migrate_table_window(conn, table_key, window)
+
+def _migrate_table_window(conn, table_key, window):
     conf = TABLES_CONFIG[table_key]
     
     last_t_iso = window.get("last_checkpoint_time")
@@ -315,37 +676,52 @@ def migrate_table_window(table_key, window):
     
     processed_since_resume = 0
     consecutive_errors = 0
+    batch_size = AdaptiveBatchSize(conf.get("batch_size", BATCH_SIZE))
     
     update_checkpoint_window(table_key, window, last_t_iso, last_id, 0, status="in_progress")
     
+    prefetcher = None
     while True:
+        if shutdown_event.is_set():
+            logger.warning(f"{table_key} 收到終止訊號，於批次邊界停止並寫出 checkpoint...")
+            if prefetcher: prefetcher = prefetcher.close()
+            conn.rollback()
+            update_checkpoint_window(table_key, window, last_t_iso, last_id, 0, status="pending")
+            raise RuntimeError(f"{table_key} 收到終止訊號，視窗已停在斷點並標記為 pending，可用 --resume 繼續。")
         try:
-            rows = fetch_batch(table_key, window["end"], last_t_iso, last_id, BATCH_SIZE)
+            if prefetcher is None:
+                prefetcher = WindowBatchPrefetcher(conn, table_key, window["end"], last_t_iso, last_id, batch_size)
+            rows, requested_size = prefetcher.get()
             
             if not rows:
+                prefetcher = prefetcher.close()
+                conn.commit()
                 update_checkpoint_window(table_key, window, last_t_iso, last_id, 0, status="completed")
                 total_processed = window.get("processed_count", 0)
                 logger.info(f"{table_key} 視窗 {window['start']}~{window['end']} 同步完成，本次執行處理了 {processed_since_resume} 筆，累計處理 {total_processed} 筆")
                 break
             
-            result = upsert_batch(table_key, rows)
+            write_started = time.monotonic()
+            inserted, updated = upsert_batch(table_key, rows, window.get("mode"), prefetcher.row_plan)
+            batch_size.record(len(rows), requested_size, time.monotonic() - write_started)
             
             processed_this_batch = len(rows)
             
-            inserted = result.upserted_count if result else 0
-            updated = result.modified_count if result else 0
-            if "embed_array_field" in conf or table_key == "hcc_events":
+            # 嵌入陣列表每個活動合併為一筆 $addToSet，更新數即為實際被修改的活動文件數，不再以來源列數覆寫
+            if table_key == "hcc_events":
                 updated = processed_this_batch
 
-            table_stats = MIGRATION_STATS["tables"].setdefault(table_key, {"pg_records": 0, "inserted": 0, "updated": 0})
-            table_stats["pg_records"] += processed_this_batch
-            table_stats["inserted"] += inserted
-            table_stats["updated"] += updated
-            MIGRATION_STATS["total_pg_records"] += processed_this_batch
-            MIGRATION_STATS["total_inserted"] += inserted
-            MIGRATION_STATS["total_updated"] += updated
+            with stats_lock:
+                table_stats = MIGRATION_STATS["tables"].setdefault(table_key, {"pg_records": 0, "inserted": 0, "updated": 0})
+                table_stats["pg_records"] += processed_this_batch
+                table_stats["inserted"] += inserted
+                table_stats["updated"] += updated
+                MIGRATION_STATS["total_pg_records"] += processed_this_batch
+                MIGRATION_STATS["total_inserted"] += inserted
+                MIGRATION_STATS["total_updated"] += updated
 
-            last_row = rows[-1]
+            # 只為每批最後一列建立欄位對照，取出斷點欄位
+            last_row = dict(zip(prefetcher.columns, rows[-1]))
             time_key_value = last_row.get(conf["mod_date_field"]) or last_row.get(conf["add_date_field"])
             id_key_value = last_row.get(conf["id_field"])
 
@@ -357,40 +733,90 @@ def migrate_table_window(table_key, window):
             
             update_checkpoint_window(table_key, window, last_t_iso, last_id, processed_this_batch, status="in_progress")
             processed_since_resume += processed_this_batch
-            logger.info(f"{table_key} 批次同步成功: records={len(rows)}, last_time={last_t_iso}, last_id={last_id}")
+            logger.debug("%s 批次同步成功: records=%d, last_time=%s, last_id=%s", table_key, len(rows), last_t_iso, last_id)
             consecutive_errors = 0
             
         except psycopg2.Error as pg_err:
             consecutive_errors += 1
-            logger.error(f"PostgreSQL 發生錯誤，正在回滾事務: {pg_err}")
-            pg_conn.rollback()
+            logger.error(f"PostgreSQL 發生錯誤，正在回滾事務並從斷點重新開啟資料流: {pg_err}")
+            if prefetcher: prefetcher = prefetcher.close()
+            conn.rollback()
         except Exception as e:
             consecutive_errors += 1
             logger.error(f"{table_key} 視窗同步批次異常，第 {consecutive_errors} 次錯誤: {e}", exc_info=True)
+            # 預取的資料流已越過未寫入的批次，需停止預取並從最後斷點重新開啟
+            if prefetcher: prefetcher = prefetcher.close()
+            conn.rollback()
             if consecutive_errors >= 5:
                 update_checkpoint_window(table_key, window, last_t_iso, last_id, 0, status="pending")
                 logger.error(f"{table_key} 視窗因連續錯誤而終止，狀態已改為 pending。")
                 raise e
             
-def convert_decimal_for_json(obj):
-    if isinstance(obj, dict): return {k: convert_decimal_for_json(v) for k, v in obj.items()}
-    elif isinstance(obj, list): return [convert_decimal_for_json(elem) for elem in obj]
-    elif isinstance(obj, Decimal): return str(obj)
-    else: return obj
+def _checkpoint_json_default(obj):
+    if isinstance(obj, Decimal): return str(obj)
+    raise TypeError(f"無法序列化型別: {type(obj).__name__}")
 
 def load_checkpoint():
     if os.path.exists(CHECKPOINT_FILE):
-        with open(CHECKPOINT_FILE, "r", encoding="utf-8") as f:
-            try: return json.load(f)
-            except json.JSONDecodeError:
+        with open(CHECKPOINT_FILE, "rb") as f:
+            try: return orjson.loads(f.read())
+            except orjson.JSONDecodeError:
                 logger.error(f"{CHECKPOINT_FILE} 格式錯誤，將建立新檔案。")
                 return {}
     return {}
 
+def write_checkpoint_bytes(data_bytes):
+    # 先寫暫存檔再原子替換，中途中斷也不會留下半截的 checkpoint
+    tmp_file = f"{CHECKPOINT_FILE}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(data_bytes)
+    os.replace(tmp_file, CHECKPOINT_FILE)
+
+class CheckpointFlusher:
+    """
+    背景執行緒負責 checkpoint 落盤：佇列只保留最新一份快照，尚未寫出的舊快照直接丟棄，
+    同步主流程只需序列化 (orjson 很快)，檔案 I/O 不再卡住批次迴圈。
+    """
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=1)
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="checkpoint-flusher", daemon=True)
+        self._thread.start()
+
+    def submit(self, data_bytes):
+        with self._lock:
+            try:
+                self._queue.get_nowait()
+                self._queue.task_done()
+            except queue.Empty:
+                pass
+            self._queue.put_nowait(data_bytes)
+
+    def drain(self):
+        """等待已提交的快照全部寫入磁碟。"""
+        self._queue.join()
+
+    def stop(self):
+        self.drain()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            data_bytes = self._queue.get()
+            try:
+                if data_bytes is None: return
+                write_checkpoint_bytes(data_bytes)
+            except Exception as e:
+                logger.error(f"背景寫入 checkpoint 失敗: {e}", exc_info=True)
+            finally:
+                self._queue.task_done()
+
 def save_checkpoint(data):
-    safe_data = convert_decimal_for_json(data)
-    with open(CHECKPOINT_FILE, "w", encoding="utf-8") as f:
-        json.dump(safe_data, f, ensure_ascii=False, indent=2)
+    # orjson 直接輸出 UTF-8 bytes，Decimal 於序列化時轉為字串；序列化在呼叫端完成 (持有 checkpoint_lock 時即為一致快照)
+    data_bytes = orjson.dumps(data, default=_checkpoint_json_default, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    if checkpoint_flusher: checkpoint_flusher.submit(data_bytes)
+    else: write_checkpoint_bytes(data_bytes)
 
 def log_discrepancy_details(key, conf):
     logger.warning(f"--- [ {key} ] 遺漏資料詳細清單 (最多顯示 20 筆) ---")
@@ -399,23 +825,26 @@ def log_discrepancy_details(key, conf):
     try:
         pg_table = f"{SCHEMA}.{conf['pg_table']}"
         link_field = conf.get("link_field", "event_no")
-        with pg_conn.cursor() as cur:
+        # 使用伺服器端命名游標分段串流 ID，避免 fetchall() 一次把整表 ID 載入記憶體
+        with pg_conn.cursor(name=f"diff_{key}") as cur:
+            cur.itersize = BATCH_SIZE
             if key == "coupon_burui":
                 sql = f"SELECT DISTINCT s.event_no, t.branch FROM {pg_table} t JOIN {SCHEMA}.gif_event_coupon_setting s ON t.coupon_setting_no = s.coupon_setting_no WHERE s.event_no = ANY(%s) AND t.branch IS NOT NULL AND t.branch != ''"
-                cur.execute(sql, (list(VALID_EVENT_NOS),))
-                pg_ids = {f"{row[0]}:{row[1]}" for row in cur.fetchall()}
+                cur.execute(sql, (VALID_EVENT_NOS_LIST,))
+                pg_ids = {f"{row[0]}:{row[1]}" for row in cur}
             else:
                 pk_field = conf['id_field']
-                sql = f"SELECT {pk_field} FROM {pg_table} WHERE {link_field} = ANY(%s);"
-                cur.execute(sql, (list(VALID_EVENT_NOS),))
-                pg_ids = {str(row[0]) for row in cur.fetchall()}
+                sql = f"SELECT {pk_field} FROM {pg_table} WHERE {link_field} = ANY(%s)"
+                cur.execute(sql, (VALID_EVENT_NOS_LIST,))
+                pg_ids = {str(row[0]) for row in cur}
+        pg_conn.commit()
 
         mongo_collection = mongo_dbs[key]
         if conf.get("verification_mode") == "embed_array":
             arr_field = conf["embed_array_field"]
             key_field = "branch" if key == "coupon_burui" else "memberType"
             pipeline = [
-                {"$match": {"eventNo": {"$in": list(VALID_EVENT_NOS)}}},
+                {"$match": {"eventNo": {"$in": VALID_EVENT_NOS_LIST}}},
                 {"$unwind": f"${arr_field}"}
             ]
             if key == "coupon_burui":
@@ -426,7 +855,7 @@ def log_discrepancy_details(key, conf):
             mongo_ids = {item['combinedKey'] for item in mongo_results}
         else:
             pk_field_camel = snake_to_camel(conf['id_field'])
-            cursor = mongo_collection.find({"eventNo": {"$in": list(VALID_EVENT_NOS)}}, {pk_field_camel: 1, "_id": 0})
+            cursor = mongo_collection.find({"eventNo": {"$in": VALID_EVENT_NOS_LIST}}, {pk_field_camel: 1, "_id": 0})
             mongo_ids = {str(doc[pk_field_camel]) for doc in cursor if pk_field_camel in doc}
 
         missing_from_mongo = sorted(list(pg_ids - mongo_ids))
@@ -439,6 +868,7 @@ def log_discrepancy_details(key, conf):
             logger.warning("計數不一致，但未找到具體遺漏的 ID，可能是 MongoDB 中存在重複或額外的資料。")
     except Exception as e:
         logger.error(f"執行差異分析時出錯: {e}", exc_info=True)
+        if isinstance(e, psycopg2.Error): pg_conn.rollback()
     logger.warning("----------------------------------------------------")
 
 def verify_consistency():
@@ -449,20 +879,41 @@ def verify_consistency():
         logger.warning("白名單為空，跳過資料一致性校驗。")
         return True
     
+    # 各表的 PG 計數合併為一次 UNION ALL 查詢；白名單以具名參數傳入，每個子查詢仍是常數陣列 (PG 14+ 可對 = ANY 建雜湊表)
+    count_sqls = {}
+    for key, conf in TABLES_CONFIG.items():
+        pg_table = f"{SCHEMA}.{conf['pg_table']}"
+        link_field = conf.get("link_field", "event_no")
+        if key == "coupon_burui":
+            count_sqls[key] = f"SELECT '{key}', COUNT(*) FROM (SELECT DISTINCT s.event_no, t.branch FROM {pg_table} t JOIN {SCHEMA}.gif_event_coupon_setting s ON t.coupon_setting_no = s.coupon_setting_no WHERE s.event_no = ANY(%(nos)s) AND t.branch IS NOT NULL AND t.branch != '') AS distinct_rows"
+        else:
+            count_sqls[key] = f"SELECT '{key}', COUNT(*) FROM {pg_table} WHERE {link_field} = ANY(%(nos)s)"
+    
+    # 同一 collection 的各嵌入陣列總數以一次聚合同時算出，events 不必為每個嵌入表各掃描一次
+    embed_fields_by_collection = defaultdict(set)
+    for conf in TABLES_CONFIG.values():
+        if conf.get("verification_mode") == "embed_array":
+            embed_fields_by_collection[conf["mongo_collection"]].add(conf["embed_array_field"])
+    embed_totals = {}
+    
     with pg_conn.cursor() as cur:
+        pg_counts = {}
+        try:
+            cur.execute(" UNION ALL ".join(count_sqls.values()), {"nos": VALID_EVENT_NOS_LIST})
+            pg_counts = dict(cur.fetchall())
+        except psycopg2.Error as e:
+            logger.warning(f"合併計數查詢失敗，改為逐表計數: {e}")
+            pg_conn.rollback()
+        
         for key, conf in TABLES_CONFIG.items():
             mode = conf.get("verification_mode")
-            pg_table = f"{SCHEMA}.{conf['pg_table']}"
-            link_field = conf.get("link_field", "event_no")
             pg_count = 0
             try:
-                if key == "coupon_burui":
-                    sql = f"SELECT COUNT(*) FROM (SELECT DISTINCT s.event_no, t.branch FROM {pg_table} t JOIN {SCHEMA}.gif_event_coupon_setting s ON t.coupon_setting_no = s.coupon_setting_no WHERE s.event_no = ANY(%s) AND t.branch IS NOT NULL AND t.branch != '') AS distinct_rows;"
+                if key in pg_counts:
+                    pg_count = pg_counts[key]
                 else:
-                    sql = f"SELECT COUNT(*) FROM {pg_table} WHERE {link_field} = ANY(%s);"
-                
-                cur.execute(sql, (list(VALID_EVENT_NOS),))
-                pg_count = cur.fetchone()[0]
+                    cur.execute(count_sqls[key], {"nos": VALID_EVENT_NOS_LIST})
+                    pg_count = cur.fetchone()[1]
 
                 result_str = ""
                 is_consistent = False
@@ -475,12 +926,18 @@ def verify_consistency():
                     mongo_count = 0
                     if mode == "embed_array":
                         arr_field = conf["embed_array_field"]
-                        pipeline = [{"$match": {"eventNo": {"$in": list(VALID_EVENT_NOS)}}}, {"$project": {"count": {"$size": {"$ifNull": [f"${arr_field}", []]}}}}, {"$group": {"_id": None, "total": {"$sum": "$count"}}}]
-                        mongo_result = list(mongo_collection.aggregate(pipeline))
-                        mongo_count = mongo_result[0]['total'] if mongo_result else 0
+                        collection_name = conf["mongo_collection"]
+                        if collection_name not in embed_totals:
+                            group_stage = {"_id": None}
+                            for field in sorted(embed_fields_by_collection[collection_name]):
+                                group_stage[field] = {"$sum": {"$size": {"$ifNull": [f"${field}", []]}}}
+                            pipeline = [{"$match": {"eventNo": {"$in": VALID_EVENT_NOS_LIST}}}, {"$group": group_stage}]
+                            mongo_result = list(mongo_collection.aggregate(pipeline))
+                            embed_totals[collection_name] = mongo_result[0] if mongo_result else {}
+                        mongo_count = embed_totals[collection_name].get(arr_field, 0)
                         result_str = f"嵌入陣列 {conf['pg_table']}: PG(理論)={pg_count}, MG(實際)={mongo_count}"
                     else: # primary_count
-                        mongo_count = mongo_collection.count_documents({"eventNo": {"$in": list(VALID_EVENT_NOS)}})
+                        mongo_count = mongo_collection.count_documents({"eventNo": {"$in": VALID_EVENT_NOS_LIST}})
                         result_str = f"主計數 {conf['pg_table']}: PG={pg_count}, MG={mongo_count}"
                     
                     is_consistent = (pg_count == mongo_count)
@@ -499,15 +956,97 @@ def verify_consistency():
     logger.info("資料一致性校驗完畢。")
     return all_ok
 
+def run_windows_in_lanes(windows_by_table):
+    """
+    依 EXECUTION_LANES 以執行緒池並行處理各分道；分道內的表與視窗仍依序執行。
+    任一分道失敗時，待其他分道結束後再拋出第一個例外。
+    """
+    def run_lane(lane):
+        for table_key in lane:
+            for window in windows_by_table.get(table_key, []):
+                logger.info(f"--- 開始處理表: {table_key} ({window.get('mode', 'full')} 視窗 {window['start']} -> {window['end']}) ---")
+                migrate_table_window(table_key, window)
+
+    lanes = [lane for lane in EXECUTION_LANES if any(windows_by_table.get(k) for k in lane)]
+    if not lanes:
+        return
+    first_error = None
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(lanes))), thread_name_prefix="lane") as executor:
+        futures = {executor.submit(run_lane, lane): lane for lane in lanes}
+        try:
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"分道 {futures[future]} 執行失敗: {e}")
+                    first_error = first_error or e
+        except BaseException:
+            # Ctrl-C 等中斷：通知各分道於批次邊界停下並標記 pending，否則離開 with 時會等所有視窗跑完
+            shutdown_event.set()
+            raise
+    if first_error:
+        raise first_error
+
+def drop_indexes_for_full_sync():
+    """
+    全量同步前暫時移除 insert_on_full_sync 表的唯一索引，改在同步後一次重建，省去每批寫入的索引維護。
+    只在目標集合為空時才移除：已有資料時重跑需靠唯一索引辨識重複。回傳已移除索引的表。
+    """
+    dropped = []
+    for table_key, conf in TABLES_CONFIG.items():
+        if not conf.get("insert_on_full_sync"): continue
+        collection = mongo_dbs[table_key]
+        # 不確認寫入 (w=0) 時改走 upsert，其 (eventNo, appId) 篩選需要唯一索引，移除後每筆都會全表掃描
+        if not collection.write_concern.acknowledged:
+            logger.warning(f"MONGO_WRITE_CONCERN=0 時 {conf['mongo_collection']} 以 upsert 寫入，需保留唯一索引，略過 --drop-indexes-for-full-sync。")
+            continue
+        if collection.estimated_document_count() > 0:
+            logger.warning(f"{conf['mongo_collection']} 已有資料，保留唯一索引以辨識重複資料。")
+            continue
+        existing = collection.index_information()
+        for index_model in MONGO_INDEXES.get(conf["mongo_collection"], []):
+            if index_model.document["name"] in existing:
+                collection.drop_index(index_model.document["name"])
+                logger.info(f"已暫時移除 {conf['mongo_collection']} 索引: {index_model.document['name']}")
+        dropped.append(table_key)
+    return dropped
+
+def rebuild_indexes_after_full_sync(table_keys):
+    for table_key in table_keys:
+        conf = TABLES_CONFIG[table_key]
+        collection = mongo_dbs[table_key]
+        # 剛載入的大集合上全表去重與建索引可能超過 socketTimeoutMS，改用管理操作的時限
+        with mongo_timeout(MONGO_ADMIN_TIMEOUT_SECONDS):
+            # 無唯一索引期間，錯誤重試可能重複寫入同一批資料；重建前每組唯一鍵只保留一筆
+            for index_model in MONGO_INDEXES[conf["mongo_collection"]]:
+                if index_model.document.get("unique"):
+                    remove_duplicates_for_unique_index(collection, index_model)
+            logger.info(f"開始重建 {conf['mongo_collection']} 索引...")
+            collection.create_indexes(MONGO_INDEXES[conf["mongo_collection"]])
+        logger.info(f"{conf['mongo_collection']} 索引重建完成。")
+
+def restore_missing_unique_indexes():
+    """
+    全量同步若被強制終止，finally 未執行，insert_on_full_sync 表的唯一索引會維持移除狀態；
+    即使以 --skip-mongo-index-check 啟動，恢復寫入前也先去重並補建，避免 insert 路徑持續寫入重複文件。
+    """
+    table_keys = []
+    for table_key, conf in TABLES_CONFIG.items():
+        if not conf.get("insert_on_full_sync"): continue
+        existing = mongo_dbs[table_key].index_information()
+        if any(m.document["name"] not in existing for m in MONGO_INDEXES.get(conf["mongo_collection"], [])):
+            logger.warning(f"{conf['mongo_collection']} 缺少唯一索引 (可能是先前的全量同步被中斷)，將去重後重建。")
+            table_keys.append(table_key)
+    rebuild_indexes_after_full_sync(table_keys)
+
 def command_full_sync():
     global cp_data
     logger.warning("執行全量同步 (--full-sync) 將會清空現有的 checkpoint 進度。")
     cp_data = {}
-    end_time = "9999-12-31T23:59:59Z"
     for table_key in TABLES_CONFIG.keys():
         window = {
             "start": "1970-01-01T00:00:00Z", 
-            "end": end_time, 
+            "end": FULL_SYNC_END_TIME, 
             "status": "pending", 
             "mode": "full",
             "last_checkpoint_time": "1970-01-01T00:00:00Z",
@@ -519,11 +1058,12 @@ def command_full_sync():
     save_checkpoint(cp_data)
     logger.info(f"已為所有表建立/重置全量同步視窗。")
     
-    execution_order = ["events", "hcc_events", "attendees", "coupon_burui", "member_types"]
-    for table_key in execution_order:
-        logger.info(f"--- 開始處理表: {table_key} ---")
-        window = cp_data[table_key]["base_windows"][0]
-        migrate_table_window(table_key, window)
+    dropped = drop_indexes_for_full_sync() if args.drop_indexes_for_full_sync else []
+    try:
+        run_windows_in_lanes({table_key: [cp_data[table_key]["base_windows"][0]] for table_key in TABLES_CONFIG})
+    finally:
+        # 即使同步中斷也要重建，之後的 --resume 才能依唯一索引辨識重複資料
+        rebuild_indexes_after_full_sync(dropped)
 
 def get_latest_checkpoint_for_table(table_key):
     """
@@ -547,23 +1087,20 @@ def get_latest_checkpoint_for_table(table_key):
 def command_incremental():
     global cp_data
     end_time_utc = datetime.datetime.now(timezone.utc)
-    execution_order = ["events", "hcc_events", "attendees", "coupon_burui", "member_types"]
 
     # *** 最終核心邏輯修正 ***
     # 廢除「全局斷點」，改為在循環中為【每個表】獨立查找其自身的最新斷點。
     # 這確保了每個表的進度是獨立維護的，從根本上避免了數據類型污染問題。
-    for table_key in execution_order:
+    # 所有視窗先依序建立並落盤，之後才交由各分道並行同步，避免並行期間重新載入 checkpoint 覆蓋進度。
+    cp_data = load_checkpoint()
+    new_windows = {}
+    for table_key in TABLES_CONFIG:
         logger.info(f"--- 正在為表 '{table_key}' 準備增量任務 ---")
         
         # 1. 為當前表獨立查找其最新的斷點
         latest_checkpoint_time, latest_checkpoint_id = get_latest_checkpoint_for_table(table_key)
         
-        # 2. 重新從磁碟加載 checkpoint 檔案，以防被其他進程修改
-        cp_data = load_checkpoint()
-        table_data = cp_data.setdefault(table_key, {})
-        base_windows = table_data.setdefault("base_windows", [])
-        
-        # 3. 創建新的任務窗口，起點是【該表自己】的最新斷點
+        # 2. 創建新的任務窗口，起點是【該表自己】的最新斷點
         new_window = {
             "start": latest_checkpoint_time, 
             "end": end_time_utc.isoformat(), 
@@ -573,26 +1110,26 @@ def command_incremental():
             "last_checkpoint_id": latest_checkpoint_id,
             "processed_count": 0
         }
-        base_windows.append(new_window)
+        cp_data.setdefault(table_key, {}).setdefault("base_windows", []).append(new_window)
+        new_windows[table_key] = [new_window]
         logger.info(f"新增 {table_key} 增量同步視窗：{new_window['start']} ~ {new_window['end']} (繼承【自身】斷點)")
-        save_checkpoint(cp_data)
-        
-        # 4. 執行同步
-        migrate_table_window(table_key, new_window)
+    save_checkpoint(cp_data)
+    
+    # 3. 執行同步
+    run_windows_in_lanes(new_windows)
 
 def command_resume():
+    global cp_data
     logger.info("開始執行斷點恢復任務...")
-    execution_order = ["events", "hcc_events", "attendees", "coupon_burui", "member_types"]
-    for table_key in execution_order:
-        current_cp_data = load_checkpoint()
-        if table_key not in current_cp_data: continue
-        
-        for w in current_cp_data[table_key].get("base_windows", []):
+    cp_data = load_checkpoint()
+    pending_windows = {}
+    for table_key in TABLES_CONFIG:
+        for w in cp_data.get(table_key, {}).get("base_windows", []):
             if w.get("status") in ("pending", "in_progress"):
                 logger.info(f"恢復處理 '{table_key}' 的 {w.get('mode', 'full')} 模式視窗: {w['start']} -> {w['end']}")
-                global cp_data
-                cp_data = current_cp_data
-                migrate_table_window(table_key, w)
+                pending_windows.setdefault(table_key, []).append(w)
+    restore_missing_unique_indexes()
+    run_windows_in_lanes(pending_windows)
 
 def command_show_status():
     """顯示當前 checkpoint 狀態"""
@@ -646,7 +1183,12 @@ def parse_args():
     group.add_argument("--resume", action="store_true", help="恢復處理狀態為 'pending' 或 'in_progress' 的任務。")
     group.add_argument("--show-status", action="store_true", help="顯示當前 checkpoint 的狀態摘要。")
     group.add_argument("--reset", action="store_true", help="重置(刪除) checkpoint 檔案，以便從頭開始。")
+    group.add_argument("--init-indexes", action="store_true", help="只建立 PostgreSQL 與 MongoDB 索引後結束 (一次性部署用)。")
     parser.add_argument("--skip-pg-index-check", action="store_true", help="跳過啟動時的 PostgreSQL 索引檢查。")
+    parser.add_argument("--skip-mongo-index-check", action="store_true", help="跳過啟動時的 MongoDB 索引檢查。")
+    parser.add_argument("--drop-indexes-for-full-sync", action="store_true", help="全量同步時若目標集合為空，先移除唯一索引，同步後再重建。")
+    parser.add_argument("--safe-write", action="store_true", help="MongoDB 寫入改用 w=majority (預設 w=1、不等待 journal)。")
+    parser.add_argument("--verbose", action="store_true", help="輸出 DEBUG 等級日誌 (逐批進度、執行的 SQL)。")
     return parser.parse_args()
 
 def log_summary_report(start_time, end_time, task_name):
@@ -696,13 +1238,18 @@ def log_summary_report(start_time, end_time, task_name):
     report_lines.extend(["", "=" * 25 + " [ 報告結束 ] " + "=" * 25])
     for line in report_lines: logger.info(line)
 
+def handle_sigterm(signum, frame):
+    # 訊號處理器內不可記錄日誌：QueueHandler 的佇列鎖不可重入，主執行緒正在記錄時會死結；由視窗迴圈記錄停止訊息
+    shutdown_event.set()
+
 def main():
-    global cp_data, args
+    global cp_data, args, checkpoint_flusher
     start_time = datetime.datetime.now()
     args = parse_args()
-    task_name_map = {"full_sync": "full-sync", "incremental": "incremental", "resume": "resume", "show_status": "show-status", "reset": "reset"}
+    task_name_map = {"full_sync": "full-sync", "incremental": "incremental", "resume": "resume", "show_status": "show-status", "reset": "reset", "init_indexes": "init-indexes"}
     task_name = next((v for k, v in task_name_map.items() if getattr(args, k, False)), "unknown")
-    init_logger(task_name=task_name)
+    # 互動式/唯讀指令維持同步輸出，確保提示訊息順序正確
+    init_logger(task_name=task_name, background=task_name not in ("show-status", "reset"), verbose=args.verbose)
     logger.info(f"===== 開始執行遷移任務: {task_name} =====")
     
     try:
@@ -713,8 +1260,13 @@ def main():
             return
 
         init_db_conn()
+        if args.init_indexes:
+            logger.info("索引建立完成，結束 --init-indexes。")
+            return
         cp_data = load_checkpoint()
         load_valid_event_nos()
+        checkpoint_flusher = CheckpointFlusher()
+        signal.signal(signal.SIGTERM, handle_sigterm)
 
         if args.full_sync: command_full_sync()
         elif args.incremental: command_incremental()
@@ -728,13 +1280,16 @@ def main():
         MIGRATION_STATS["verification_results"].append(f"❌ FAIL: 任務因異常而終止 - {e}")
         sys.exit(1)
     finally:
-        if pg_conn: pg_conn.close()
+        # 結束前等待背景執行緒寫出最後一份 checkpoint
+        if checkpoint_flusher: checkpoint_flusher.stop()
+        if pg_pool: pg_pool.closeall()
         if mongo_client: mongo_client.close()
         end_time = datetime.datetime.now()
         
-        if not (getattr(args, 'show_status', False) or getattr(args, 'reset', False)):
+        if not (getattr(args, 'show_status', False) or getattr(args, 'reset', False) or getattr(args, 'init_indexes', False)):
             log_summary_report(start_time, end_time, task_name)
         logger.info(f"===== 遷移任務結束: {task_name} =====")
+        if log_listener: log_listener.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file